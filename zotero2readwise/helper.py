@@ -12,24 +12,60 @@
 #
 # Dependencies:
 #     pip install beautifulsoup4
+#     pip install lxml
 #
 
 from __future__ import annotations
 import re
+from functools import lru_cache
 from html import unescape
-from typing import List, Union
+from typing import Any, Callable, Dict, List
 
 from bs4 import BeautifulSoup, NavigableString, Tag
+from bs4.element import PreformattedString
+
+try:
+    import lxml  # noqa: F401
+
+    # libxml2-backed tree builder, much faster than the pure-Python parser
+    _PARSER = "lxml"
+except ImportError:
+    _PARSER = "html.parser"
 
 __all__ = [
     "html_to_markdown",
+    "read_library_version",
     "sanitize_tag",
+    "write_library_version",
 ]
 
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
 
+# Tags whose whole subtree never contributes to the Markdown output
+_SKIP_TAGS = frozenset({"script", "style", "meta", "link", "head"})
+
+_HEADING_LEVELS = {f"h{level}": level for level in range(1, 7)}
+
+_LIST_TAGS = frozenset({"ul", "ol"})
+
+# 嵌套列表每层的缩进
+_LIST_INDENT = "  "
+
+# Called with (node, out, mark) once the children of node are in out[mark:]
+_Closer = Callable[[Tag, List[str], int], None]
+
+# Patterns used on every call, compiled once at import time
+_RE_QUOTE_NL = re.compile(r"\n+")
+_RE_EOL = re.compile(r"\r\n|\r")
+_RE_TRAILING_WS = re.compile(r"[ \t]+\n")
+_RE_BLANK3 = re.compile(r"\n{3,}")
+
+# Zotero library version of the last run, used by ``run.py --use_since``
+_LIBRARY_VERSION_FILE = "since"
+
+
 def sanitize_tag(tag: str) -> str:
     """
     Sanitize a tag string for use with Readwise.
@@ -37,12 +73,42 @@ def sanitize_tag(tag: str) -> str:
     """
     return tag.replace(" ", "_").replace("-", "_")
 
+@lru_cache(maxsize=None)
+def read_library_version() -> int:
+    """
+    Read the Zotero library version saved by the last run.
+
+    The value is cached until :func:`write_library_version` stores a new
+    one, so repeated calls do not touch the disk. Returns 0 (i.e. fetch
+    everything) if no valid version has been saved yet.
+    """
+    try:
+        # 文件只含一个整数：按字节读取，int() 可直接解析
+        with open(_LIBRARY_VERSION_FILE, "rb") as file:
+            return int(file.read())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def write_library_version(zotero_client) -> None:
+    """Save the current Zotero library version for the next ``--use_since`` run."""
+    # 先取版本号再打开文件：请求失败时不会留下被截断的空文件
+    version = zotero_client.last_modified_version()
+    with open(_LIBRARY_VERSION_FILE, "w") as file:
+        file.write(str(version))
+    read_library_version.cache_clear()
+
 def _strip_tex(tex: str) -> str:
     """Remove leading/trailing LaTeX delimiters like $, $$, \\[ … \\]."""
     tex = tex.strip()
     # 移除开头和结尾的 $ 或 $$，也去除 \[ ... \] 包裹
-    tex = re.sub(r"^\$\$?", "", tex)
-    tex = re.sub(r"\$\$?$", "", tex)
+    if tex.startswith("$$"):
+        tex = tex[2:]
+    elif tex.startswith("$"):
+        tex = tex[1:]
+    if tex.endswith("$$"):
+        tex = tex[:-2]
+    elif tex.endswith("$"):
+        tex = tex[:-1]
     if tex.startswith("\\[") and tex.endswith("\\]"):
         tex = tex[2:-2].strip()
     return tex.strip()
@@ -62,113 +128,227 @@ def _wrap_code(text: str) -> str:
         text_escaped = text.replace("`", "\\`")  # 简单转义反引号
         return f"`{text_escaped}`"
 
-def _list_to_md(list_tag: Tag, bullet: str) -> str:
-    items = []
-    for li in list_tag.find_all("li", recursive=False):
-        # 嵌套列表可自行扩展，这里只处理一层
-        content = _children_to_md(li).strip()
-        items.append(f"{bullet}{content}")
-    return "\n".join(items) + "\n"
-
-def _children_to_md(parent: Tag) -> str:
-    """Convert all children of a parent node to Markdown, recursively."""
-    return "".join(_walk(child) for child in parent.children)
-
 # ---------------------------------------------------------------------------
 # Core traversal
 # ---------------------------------------------------------------------------
 
-def _walk(node: Union[Tag, NavigableString]) -> str:
-    """Depth‑first traversal that converts *node* to Markdown."""
+def _strip_fragments(out: List[str], mark: int) -> None:
+    """Strip ``out[mark:]`` in place, as ``"".join(out[mark:]).strip()`` would."""
+    i = mark
+    while i < len(out):
+        out[i] = out[i].lstrip()
+        if out[i]:
+            break
+        i += 1
+    j = len(out) - 1
+    while j >= i:
+        out[j] = out[j].rstrip()
+        if out[j]:
+            break
+        j -= 1
+
+def _math_to_md(node: Tag, name: str) -> str:
+    """(a) 数学公式：``class="math"`` 的元素转换为 ``$…$`` 或 ``$$…$$``."""
+    # 公式节点通常只含一段文本：直接取 .string，避免 get_text 的整树遍历
+    tex_raw = node.string
+    if tex_raw is None:
+        # 多段文本时逐段 strip 后拼接，段间换行不影响行内/块级判断
+        tex_raw = node.get_text("", strip=True)
+    else:
+        tex_raw = tex_raw.strip()
+    tex = _strip_tex(tex_raw)
+    # 如果 tag 是 <pre class="math"> 或本身包含换行，就作为 block 公式
+    is_block = (name == "pre") or ("\n" in tex_raw)
+    return f"\n$$\n{tex}\n$$\n" if is_block else f"${tex}$"
 
-    # 1) Text node
-    if isinstance(node, NavigableString):
-        return unescape(str(node))
+# -- Leaf handlers: convert the whole element, children are not walked ------
 
-    # 2) Element node
-    name = node.name.lower()
-    cls: List[str] = node.get("class", [])
+def _handle_br(node: Tag, out: List[str]) -> None:
+    # (d) 换行
+    out.append("\n")
 
-    # (a) 数学公式
-    if "math" in cls:
-        tex_raw = node.get_text("", strip=True)
-        tex = _strip_tex(tex_raw)
-        # 如果 tag 是 <pre class="math"> 或本身包含换行，就作为 block 公式
-        is_block = (name == "pre") or ("\n" in tex_raw)
-        return f"\n$$\n{tex}\n$$\n" if is_block else f"${tex}$"
+def _handle_code(node: Tag, out: List[str]) -> None:
+    # (g) 行内 code；(h) <pre> 预格式化（代码块）
+    out.append(_wrap_code(node.get_text()))
 
-    # (b) 标题（h1..h6）
-    if name.startswith("h") and len(name) == 2 and name[1].isdigit():
-        level = int(name[1])
-        heading_content = _children_to_md(node).strip()
-        return f"\n{'#' * level} {heading_content}\n"
+_LEAF_HANDLERS = {
+    "br": _handle_br,
+    "code": _handle_code,
+    "pre": _handle_code,
+}
 
-    # (c) 段落
-    if name == "p":
-        paragraph_text = _children_to_md(node).strip()
-        # 在前后加空行，使段落更加清晰
-        return f"\n{paragraph_text}\n"
+# -- Container handlers: append the prefix and return the closer that ------
+# -- appends the suffix once the children are in ``out[mark:]`` ------------
 
-    # (d) 换行
-    if name == "br":
-        return "\n"
+def _close_block(node: Tag, out: List[str], mark: int) -> None:
+    _strip_fragments(out, mark)
+    out.append("\n")
 
-    # (e) 粗体
-    if name in ("strong", "b"):
-        return f"**{_children_to_md(node)}**"
-
-    # (f) 斜体
-    if name in ("em", "i"):
-        return f"*{_children_to_md(node)}*"
+def _handle_heading(node: Tag, out: List[str]) -> _Closer:
+    # (b) 标题（h1..h6）
+    out.append(f"\n{'#' * _HEADING_LEVELS[node.name]} ")
+    return _close_block
 
-    # (g) 行内 code
-    if name == "code":
-        return _wrap_code(node.get_text())
+def _handle_p(node: Tag, out: List[str]) -> _Closer:
+    # (c) 段落：在前后加空行，使段落更加清晰
+    out.append("\n")
+    return _close_block
 
-    # (h) 预格式化（代码块）
-    if name == "pre":
-        # 直接获取文本，使用三重反引号包裹
-        return _wrap_code(node.get_text())
+def _close_strong(node: Tag, out: List[str], mark: int) -> None:
+    out.append("**")
 
-    # (i) 超链接
-    if name == "a":
-        href = node.get("href", "#")
-        link_text = _children_to_md(node).strip()
-        return f"[{link_text}]({href})"
+def _handle_strong(node: Tag, out: List[str]) -> _Closer:
+    # (e) 粗体
+    out.append("**")
+    return _close_strong
 
-    # (j) 无序列表
-    if name == "ul":
-        return "\n" + _list_to_md(node, bullet="- ") + "\n"
+def _close_em(node: Tag, out: List[str], mark: int) -> None:
+    out.append("*")
 
-    # (k) 有序列表
-    if name == "ol":
-        # 对于每个 li，都在最前面用 "1. "；也可以改成自动编号
-        return "\n" + _list_to_md(node, bullet="1. ") + "\n"
+def _handle_em(node: Tag, out: List[str]) -> _Closer:
+    # (f) 斜体
+    out.append("*")
+    return _close_em
 
-    # (l) 列表项（仅当我们想手动处理时）
-    if name == "li":
-        return f"- {_children_to_md(node).strip()}\n"
+def _close_a(node: Tag, out: List[str], mark: int) -> None:
+    _strip_fragments(out, mark)
+    out.append(f"]({node.get('href', '#')})")
 
+def _handle_a(node: Tag, out: List[str]) -> _Closer:
+    # (i) 超链接
+    out.append("[")
+    return _close_a
+
+def _handle_li(node: Tag, out: List[str]) -> _Closer:
+    # (l) 不在 ul/ol 中的列表项（列表内的 li 由 _list_to_md 处理）
+    out.append("- ")
+    return _close_block
+
+def _close_blockquote(node: Tag, out: List[str], mark: int) -> None:
+    quote = "".join(out[mark:]).strip()
+    del out[mark:]
+    # 将内部换行替换为换行+> 以形成 Markdown 块引用
+    quote = _RE_QUOTE_NL.sub("\n", quote)
+    quoted = "\n".join(f"> {line}" for line in quote.splitlines())
+    out.append(f"\n{quoted}\n")
+
+def _handle_blockquote(node: Tag, out: List[str]) -> _Closer:
     # (m) 块引用
-    if name == "blockquote":
-        quote = _children_to_md(node).strip()
-        # 将内部换行替换为换行+> 以形成 Markdown 块引用
-        quote = re.sub(r"\n+", "\n", quote)
-        quoted = "\n".join(f"> {line}" for line in quote.splitlines())
-        return f"\n{quoted}\n"
+    return _close_blockquote
+
+# (n) 不在表中的标签：子节点内容原样保留
+_HANDLERS: Dict[str, Callable[[Tag, List[str]], _Closer]] = {
+    **dict.fromkeys(_HEADING_LEVELS, _handle_heading),
+    "p": _handle_p,
+    "strong": _handle_strong,
+    "b": _handle_strong,
+    "em": _handle_em,
+    "i": _handle_em,
+    "a": _handle_a,
+    "li": _handle_li,
+    "blockquote": _handle_blockquote,
+}
+
+def _list_to_md(list_tag: Tag, out: List[str], depth: int) -> None:
+    """
+    (j) 无序列表、(k) 有序列表：一次遍历直接的 li 子项.
 
-    # (n) 其他标签，递归其子节点
-    return _children_to_md(node)
+    Items of ``<ol>`` are numbered, and lists nested inside an item are
+    indented by *depth*.
+    """
+    indent = _LIST_INDENT * depth
+    ordered = list_tag.name == "ol"
+    out.append("\n")
+    mark = len(out)
+    number = 0
+    for child in list_tag.contents:
+        # 忽略 li 之间的空白文本
+        if not isinstance(child, Tag) or child.name != "li":
+            continue
+        number += 1
+        out.append(f"{indent}{number}. " if ordered else f"{indent}- ")
+        item_mark = len(out)
+        _walk(child, out, depth + 1)
+        _strip_fragments(out, item_mark)
+        out.append("\n")
+    if len(out) == mark:
+        out.append("\n")
+    out.append("\n")
+
+def _walk(root: Tag, out: List[str], depth: int = 0) -> None:
+    """
+    Depth‑first traversal that appends the Markdown for the children of
+    *root* to *out*.
+
+    Uses an explicit stack instead of recursion, so deeply nested HTML
+    cannot hit ``RecursionError`` and no Python frame is spent per node;
+    only lists nested inside list items recurse, once per nesting level
+    (*depth*). All fragments go into the single shared *out* list;
+    subtrees are only joined into a string where a wrapper has to rewrite
+    them.
+    """
+    # 栈元素：尚未访问的节点本身，或 (节点, closer, mark) 元组，
+    # 表示该元素的子节点已处理完，其输出从 out[mark] 开始。
+    # 子节点直接以 .contents 列表逆序入栈，不为每个子节点构造元组。
+    stack: List[Any] = root.contents[::-1]
+
+    while stack:
+        node = stack.pop()
+
+        # 子节点已处理完：套上当前元素的包装
+        if node.__class__ is tuple:
+            node, closer, mark = node
+            closer(node, out, mark)
+            continue
+
+        # 1) Text node：解析器已解码实体，文本可直接输出
+        if node.__class__ is NavigableString:
+            out.append(node)
+            continue
+        if isinstance(node, NavigableString):
+            # 注释、CDATA、DOCTYPE 等不属于正文
+            if not isinstance(node, PreformattedString):
+                out.append(node)
+            continue
+
+        # 2) Element node（HTML 解析器已将标签名转为小写）
+        name = node.name
+
+        # 脚本、样式等不需要转换的标签：整棵子树直接跳过
+        if name in _SKIP_TAGS:
+            continue
+
+        cls = node.attrs.get("class")
+        if cls and "math" in cls:
+            out.append(_math_to_md(node, name))
+            continue
+
+        if name in _LIST_TAGS:
+            _list_to_md(node, out, depth)
+            continue
+
+        leaf = _LEAF_HANDLERS.get(name)
+        if leaf is not None:
+            leaf(node, out)
+            continue
+
+        handler = _HANDLERS.get(name)
+        if handler is not None:
+            stack.append((node, handler(node, out), len(out)))
+
+        # 逆序压栈，使子节点按文档顺序出栈
+        stack.extend(reversed(node.contents))
 
 # ---------------------------------------------------------------------------
 # Public API
 # ---------------------------------------------------------------------------
 
-def html_to_markdown(html_content: str | None, keep_blank_lines: bool = False) -> str:
+def html_to_markdown(html_content: str | bytes | None, keep_blank_lines: bool = False) -> str:
     """
     Convert HTML text to Markdown.
     
-    :param html_content:      The full or partial HTML content.
+    :param html_content:      The full or partial HTML content. ``bytes``
+                              input is treated as UTF-8.
     :param keep_blank_lines:  If False (default), collapse multiple blank
                               lines into just one or two, for a cleaner layout.
     :return:                  A string containing Markdown.
@@ -176,24 +356,34 @@ def html_to_markdown(html_content: str | None, keep_blank_lines: bool = False) -
     if not html_content:
         return ""
 
-    soup = BeautifulSoup(html_content, "html.parser")
-
-    # 删除脚本、样式等不需要转换的标签
-    for t in soup.select("script, style, meta, link"):
-        t.decompose()
-
-    # 递归处理
-    markdown = _children_to_md(soup)
-
-    # 后处理：统一 EOL
-    markdown = re.sub(r"\r\n|\r", "\n", markdown)   # normalise EOL
+    if isinstance(html_content, str) and "<" not in html_content:
+        # 不含任何标签的纯文本（多数批注如此）：无需解析，只解码实体
+        markdown = unescape(html_content)
+    else:
+        if isinstance(html_content, bytes):
+            # Zotero stores notes as UTF-8; skip bs4's charset sniffing
+            soup = BeautifulSoup(html_content, _PARSER, from_encoding="utf-8")
+        else:
+            soup = BeautifulSoup(html_content, _PARSER)
+
+        # 遍历文档树
+        buf: List[str] = []
+        _walk(soup, buf)
+        markdown = "".join(buf)
+
+    # 后处理：每一遍只在可能命中时才运行，先用 C 实现的子串查找判断，
+    # 多数文档因此不必被正则逐字符扫描多次
+    # 统一 EOL
+    if "\r" in markdown:
+        markdown = _RE_EOL.sub("\n", markdown)   # normalise EOL
     # 去除行尾多余空格
-    markdown = re.sub(r"[ \t]+\n", "\n", markdown)
+    if " \n" in markdown or "\t\n" in markdown:
+        markdown = _RE_TRAILING_WS.sub("\n", markdown)
 
     # 是否合并多余的空行
-    if not keep_blank_lines:
+    if not keep_blank_lines and "\n\n\n" in markdown:
         # 将 3 个或更多的连续空行折叠为 2 个
-        markdown = re.sub(r"\n{3,}", "\n\n", markdown)
+        markdown = _RE_BLANK3.sub("\n\n", markdown)
 
     # 去除开头和末尾的空行
     markdown = markdown.strip("\n\r ")
@@ -283,19 +473,17 @@ if __name__ == "__main__":
             sys.exit(1)
 
         with open(file_path, 'r', encoding='utf-8') as file:
-            html_content = file.read()
-
-        markdown = html_to_markdown(html_content)
-
-        # Print the converted markdown
-        print("\nConverted Markdown:")
-        print("------------------")
-        print(markdown)
+            markdown = html_to_markdown(file.read())
 
         # Save the result to a .md file
         output_path = os.path.splitext(file_path)[0] + '.md'
         with open(output_path, 'w', encoding='utf-8') as outf:
             outf.write(markdown)
+
+        # Print the converted markdown
+        sys.stdout.write("\nConverted Markdown:\n------------------\n")
+        sys.stdout.write(markdown)
+        sys.stdout.write("\n")
         print(f"\nMarkdown saved to: {output_path}")
 
     else:
@@ -1,16 +1,48 @@
-from dataclasses import dataclass
+import sys
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from dataclasses import dataclass, fields
 from enum import Enum
-from json import dump
-import textwrap
-from typing import Dict, List, Optional, Union
+from itertools import islice
+from json import dump, dumps, loads
+from os import fdopen
+from pathlib import Path
+from tempfile import mkstemp
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Set, Union
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+
+    # Serializes straight to UTF-8 bytes, several times faster than json
+    _HAS_ORJSON = True
+except ImportError:
+    # orjson has no PyPy build: fall back to the standard library
+    _HAS_ORJSON = False
 
 from zotero2readwise import FAILED_ITEMS_DIR
 from zotero2readwise.exception import Zotero2ReadwiseError
 from zotero2readwise.helper import sanitize_tag, html_to_markdown
 from zotero2readwise.zotero import ZoteroItem
 
+# Number of highlights sent per POST request; keeps a retried request small
+HIGHLIGHTS_PER_REQUEST = 100
+# Number of POST requests in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+# Longest highlight text sent, slightly below Readwise's 8191 limit for safety
+MAX_HIGHLIGHT_LENGTH = 8000
+# Instances without a __dict__ are smaller; dataclass supports slots on 3.10+
+_DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+def _json_dumps(obj: Any) -> bytes:
+    """Serialize obj to compact UTF-8 JSON"""
+    if _HAS_ORJSON:
+        return orjson.dumps(obj)
+    return dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
 
 @dataclass
 class ReadwiseAPI:
@@ -28,7 +60,12 @@ class Category(Enum):
     podcasts = 4
 
 
-@dataclass
+# Category names of highlights, resolved once instead of per highlight
+_CAT_ARTICLE = Category.articles.name
+_CAT_BOOK = Category.books.name
+
+
+@dataclass(**_DATACLASS_SLOTS)
 class ReadwiseHighlight:
     text: str
     title: Optional[str] = None
@@ -48,7 +85,11 @@ class ReadwiseHighlight:
             self.location = None
 
     def get_nonempty_params(self) -> Dict:
-        return {k: v for k, v in self.__dict__.items() if v}
+        return {
+            f.name: getattr(self, f.name)
+            for f in fields(self)
+            if getattr(self, f.name)
+        }
 
 
 class Readwise:
@@ -56,13 +97,85 @@ class Readwise:
         self._token = readwise_token
         self._header = {"Authorization": f"Token {self._token}"}
         self.endpoints = ReadwiseAPI
-        self.failed_highlights: List = []
+        # Failed items are streamed to a JSON Lines file of this instance,
+        # created on the first failure; only the count is kept in memory
+        self._failed_path: Optional[Path] = None
+        self._failed_fp: Optional[BinaryIO] = None
+        self._failed_count = 0
+        # Long annotations split into several highlights, and their segments
+        self._split_count = 0
+        self._split_segments = 0
+        self._session = self._create_session()
+
+    def _create_session(self) -> requests.Session:
+        """Session reusing its HTTPS connections, retrying rate-limited and server errors."""
+        retry = Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # Readwise updates an existing highlight instead of duplicating it
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False,
+        )
+        session = requests.Session()
+        session.headers.update(self._header)
+        session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=MAX_CONCURRENT_REQUESTS,
+                max_retries=retry,
+            ),
+        )
+        return session
 
-    def create_highlights(self, highlights: List[Dict]) -> None:
-        resp = requests.post(
+    def create_highlights(self, highlights: Iterable[Dict]) -> int:
+        """
+        POST highlights in batches of HIGHLIGHTS_PER_REQUEST, several at a time.
+
+        `highlights` is consumed lazily, so only the batches in flight are held
+        in memory. Returns the number of highlights uploaded. The first failed
+        upload stops the remaining ones; the error then reports how many
+        highlights were uploaded before it.
+        """
+        highlights = iter(highlights)
+        uploaded = 0
+        in_flight: Set[Future] = set()
+        error = None
+        # Each request mostly waits on the network, so overlap them
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            try:
+                while batch := list(islice(highlights, HIGHLIGHTS_PER_REQUEST)):
+                    if len(in_flight) == MAX_CONCURRENT_REQUESTS:
+                        wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in [f for f in in_flight if f.done()]:
+                        in_flight.remove(future)
+                        # Getting the result re-raises a failed upload
+                        uploaded += future.result()
+                    in_flight.add(executor.submit(self._post_highlights, batch))
+                for future in as_completed(in_flight):
+                    in_flight.remove(future)
+                    uploaded += future.result()
+            except Exception as e:
+                error = e
+                for future in in_flight:
+                    future.cancel()
+
+        if error is not None:
+            # Uploads already running when the failure was noticed still finished
+            uploaded += sum(
+                f.result() for f in in_flight if not f.cancelled() and f.exception() is None
+            )
+            raise Zotero2ReadwiseError(
+                f"{error}\n{uploaded} highlights were uploaded to Readwise before the failure."
+            ) from error
+        return uploaded
+
+    def _post_highlights(self, highlights: List[Dict]) -> int:
+        resp = self._session.post(
             url=self.endpoints.highlights,
-            headers=self._header,
-            json={"highlights": highlights},
+            headers={"Content-Type": "application/json"},
+            data=_json_dumps({"highlights": highlights}),
         )
         if resp.status_code != 200:
             error_log_file = (
@@ -75,10 +188,14 @@ class Readwise:
                 f"POST request Status Code={resp.status_code} ({resp.reason})\n"
                 f"Error log is saved to {error_log_file} file."
             )
+        return len(highlights)
 
     @staticmethod
     def convert_tags_to_readwise_format(tags: List[str]) -> str:
-        return " ".join([f".{sanitize_tag(t.lower())}" for t in tags])
+        if not tags:
+            return ""
+        _sanitize_tag = sanitize_tag
+        return " ".join(f".{_sanitize_tag(t.lower())}" for t in tags)
 
     def format_readwise_note(self, tags, comment) -> Union[str, None]:
         rw_tags = self.convert_tags_to_readwise_format(tags)
@@ -97,29 +214,10 @@ class Readwise:
         highlight_note = self.format_readwise_note(
             tags=annot.tags, comment=annot.comment
         )
-        if annot.page_label and annot.page_label.isnumeric():
-            location = int(annot.page_label)
-        else:
-            location = 0
-        highlight_url = None
-        if annot.attachment_url is not None:
-            attachment_id = annot.attachment_url.split("/")[-1]
-            annot_id = annot.annotation_url.split("/")[-1]
-            highlight_url = f'zotero://open-pdf/library/items/{attachment_id}?page={location}%&annotation={annot_id}'
         return ReadwiseHighlight(
             text=annot.text,
-            title=annot.title,
             note=highlight_note,
-            author=annot.creators,
-            category=Category.articles.name
-            if annot.document_type != "book"
-            else Category.books.name,
-            highlighted_at=annot.annotated_at,
-            source_url=annot.source_url,
-            highlight_url=annot.annotation_url
-            if highlight_url is None
-            else highlight_url,
-            location=location,
+            **self._get_highlight_base(annot),
         )
 
     def post_zotero_annotations_to_readwise(
@@ -130,53 +228,79 @@ class Readwise:
             f"It may take some time depending on the number of highlights...\n"
             f"A complete message will show up once it's done!\n"
         )
-        rw_highlights = []
-        split_count = 0
-        total_segments = 0
-        
-        for annot in zotero_annotations:
-            try:
-                # Process text regardless of length - we'll split it if needed
-                segments = self._split_long_text(annot.text)
-                if len(segments) > 1:
-                    split_count += 1
-                    total_segments += len(segments)
-                    
-                for idx, segment_text in enumerate(segments, 1):
-                    # Create a copy of the annotation for each segment
-                    segment_note = annot.comment or ""
-                    
-                    # Add part indicator if this is a split annotation
-                    if len(segments) > 1:
-                        segment_note = f"(part {idx}/{len(segments)}) " + segment_note
-                    
-                    rw_highlight = self._create_highlight_for_segment(
-                        annot, 
-                        segment_text, 
-                        segment_note
-                    )
-                    rw_highlights.append(rw_highlight.get_nonempty_params())
-            except Exception as e:
-                print(f"Error processing annotation: {str(e)}")
-                self.failed_highlights.append(annot.get_nonempty_params())
-                continue  # Go to next annot
-                
+        self._split_count = 0
+        self._split_segments = 0
+        failed_before = self._failed_count
+        try:
+            uploaded = self.create_highlights(self._iter_highlight_dicts(zotero_annotations))
+        finally:
+            self._close_failed_items()
+
         # Print summary of splitting
-        if split_count > 0:
-            print(f"Split {split_count} long annotations into {total_segments} segments for Readwise import")
-            
-        self.create_highlights(rw_highlights)
+        if self._split_count > 0:
+            print(f"Split {self._split_count} long annotations into {self._split_segments} segments for Readwise import")
 
         finished_msg = ""
-        if self.failed_highlights:
+        failed = self._failed_count - failed_before
+        if failed:
             finished_msg = (
-                f"\nNOTE: {len(self.failed_highlights)} highlights (out of {len(self.failed_highlights)}) failed "
+                f"\nNOTE: {failed} highlights (out of {len(zotero_annotations)}) failed "
                 f"to upload to Readwise.\n"
             )
 
-        finished_msg += f"\n{len(rw_highlights)} highlights were successfully uploaded to Readwise.\n\n"
+        finished_msg += f"\n{uploaded} highlights were successfully uploaded to Readwise.\n\n"
         print(finished_msg)
         
+    def _iter_highlight_dicts(self, zotero_annotations: List[ZoteroItem]) -> Iterator[Dict]:
+        """
+        Yield the Readwise payload of every annotation segment.
+
+        Annotations that fail to convert are recorded as failed items and
+        skipped. Split annotations are counted in `_split_count`.
+        """
+        for annot in zotero_annotations:
+            try:
+                # Fields shared by all segments are computed once per annotation
+                base = self._get_nonempty_highlight_base(annot)
+
+                if len(annot.text) <= MAX_HIGHLIGHT_LENGTH:
+                    # Most annotations fit in one highlight: no splitting needed
+                    yield self._create_highlight_for_segment(
+                        base, annot.text, annot.comment or ""
+                    )
+                    continue
+
+                segments = self._split_long_text(annot.text)
+                if len(segments) == 1:
+                    # Only one paragraph had text: no part indicator needed
+                    yield self._create_highlight_for_segment(
+                        base, segments[0], annot.comment or ""
+                    )
+                    continue
+
+                if not segments:
+                    continue  # Whitespace-only text has nothing to upload
+
+                self._split_count += 1
+                self._split_segments += len(segments)
+
+                comment = annot.comment or ""
+                # Add part indicator as this is a split annotation
+                highlights = [
+                    self._create_highlight_for_segment(
+                        base,
+                        segment_text,
+                        f"(part {idx}/{len(segments)}) " + comment
+                    )
+                    for idx, segment_text in enumerate(segments, 1)
+                ]
+            except Exception as e:
+                print(f"Error processing annotation: {str(e)}")
+                self._record_failed_highlight(annot.get_nonempty_params())
+                continue  # Go to next annot
+            # Segments are collected first so a failing annotation yields none of them
+            yield from highlights
+
     def _split_long_text(self, text: str) -> List[str]:
         """
         Split text into segments that don't exceed Readwise's character limit.
@@ -184,10 +308,8 @@ class Readwise:
         
         Returns a list of text segments.
         """
-        MAX_LENGTH = 8000  # Slightly below Readwise's 8191 limit for safety
-        
         # If text is already short enough, return it as is
-        if len(text) <= MAX_LENGTH:
+        if len(text) <= MAX_HIGHLIGHT_LENGTH:
             return [text]
             
         # Try to split by paragraphs first (double newlines)
@@ -195,62 +317,134 @@ class Readwise:
         paragraphs = text.split("\n\n")
         
         for para in paragraphs:
-            if len(para) <= MAX_LENGTH:
+            if not para.strip():
+                # Readwise rejects highlights without text
+                continue
+            if len(para) <= MAX_HIGHLIGHT_LENGTH:
                 segments.append(para)
-            else:
-                # This paragraph is still too long, wrap it
-                segments.extend(
-                    textwrap.wrap(
-                        para, 
-                        width=MAX_LENGTH,
-                        break_long_words=False,
-                        break_on_hyphens=False
-                    )
-                )
-                
+                continue
+
+            # This paragraph is still too long: cut it into MAX_HIGHLIGHT_LENGTH slices,
+            # ending each slice at its last space when there is one
+            start = 0
+            while start < len(para):
+                end = min(start + MAX_HIGHLIGHT_LENGTH, len(para))
+                cut = para.rfind(" ", start, end) if end < len(para) else -1
+                if cut <= start:
+                    cut = end
+                segments.append(para[start:cut])
+                start = cut if cut == end else cut + 1
+
         return segments
         
-    def _create_highlight_for_segment(
-        self, annot: ZoteroItem, segment_text: str, segment_note: str
-    ) -> ReadwiseHighlight:
-        """Create a ReadwiseHighlight for a text segment from an annotation"""
-        if annot.page_label and annot.page_label.isnumeric():
-            location = int(annot.page_label)
-        else:
-            location = 0
-            
-        highlight_url = None
-        if annot.attachment_url is not None:
-            attachment_id = annot.attachment_url.split("/")[-1]
-            annot_id = annot.annotation_url.split("/")[-1]
+    def _get_highlight_base(self, annot: ZoteroItem) -> Dict:
+        """Fields shared by every highlight created from an annotation"""
+        location = 0
+        if annot.page_label:
+            try:
+                # Negative labels such as "-3" get no location, as before
+                location = max(int(annot.page_label), 0)
+            except ValueError:
+                pass
+
+        if annot.attachment_url:
+            attachment_id = annot.attachment_url.rsplit("/", 1)[-1]
+            annot_id = annot.annotation_url.rsplit("/", 1)[-1]
             highlight_url = f'zotero://open-pdf/library/items/{attachment_id}?page={location}%&annotation={annot_id}'
-            
-        return ReadwiseHighlight(
-            text=segment_text,
-            title=annot.title,
-            note=segment_note,
-            author=annot.creators,
-            category=Category.articles.name
-            if annot.document_type != "book"
-            else Category.books.name,
-            highlighted_at=annot.annotated_at,
-            source_url=annot.source_url,
-            highlight_url=annot.annotation_url
-            if highlight_url is None
-            else highlight_url,
-            location=location,
-        )
+        else:
+            highlight_url = annot.annotation_url
+
+        return {
+            "title": annot.title,
+            "author": annot.creators,
+            "category": _CAT_BOOK if annot.document_type == "book" else _CAT_ARTICLE,
+            "highlighted_at": annot.annotated_at,
+            "source_url": annot.source_url,
+            "highlight_url": highlight_url,
+            "location": location,
+        }
+
+    def _get_nonempty_highlight_base(self, annot: ZoteroItem) -> Dict:
+        """
+        Non-empty shared fields of an annotation's highlights, i.e. what
+        ReadwiseHighlight(...).get_nonempty_params() would keep of them.
+        """
+        base = {k: v for k, v in self._get_highlight_base(annot).items() if v}
+        base["location_type"] = "page"
+        return base
+
+    @staticmethod
+    def _create_highlight_for_segment(
+        base: Dict, segment_text: str, segment_note: str
+    ) -> Dict:
+        """
+        Build the Readwise payload for a text segment of an annotation.
+
+        The dict is built directly from the non-empty base fields instead of
+        going through a ReadwiseHighlight instance and get_nonempty_params().
+        """
+        highlight = dict(base)
+        if segment_text:
+            highlight["text"] = segment_text
+        if segment_note:
+            highlight["note"] = segment_note
+        return highlight
+
+    def _record_failed_highlight(self, item: Dict) -> None:
+        """Append a failed item to the failed-items file, opening it on first use"""
+        if self._failed_fp is None:
+            if self._failed_path is None:
+                FAILED_ITEMS_DIR.mkdir(parents=True, exist_ok=True)
+                # A file per instance, so other Readwise instances cannot clobber it
+                fd, path = mkstemp(
+                    prefix="failed_readwise_items.", suffix=".jsonl.part", dir=FAILED_ITEMS_DIR
+                )
+                self._failed_path = Path(path)
+                self._failed_fp = fdopen(fd, "wb")
+            else:
+                # An earlier post_zotero_annotations_to_readwise call recorded
+                # failed items already
+                self._failed_fp = open(self._failed_path, "ab")
+        self._failed_fp.write(_json_dumps(item) + b"\n")
+        self._failed_fp.flush()
+        self._failed_count += 1
+
+    @property
+    def failed_highlights(self) -> List[Dict]:
+        """Failed items recorded since the last save, read back from their file"""
+        if self._failed_path is None:
+            return []
+        with open(self._failed_path, "rb") as f:
+            return [loads(line) for line in f]
+
+    def _close_failed_items(self) -> None:
+        if self._failed_fp is not None:
+            self._failed_fp.close()
+            self._failed_fp = None
 
     def save_failed_items_to_json(self, json_filepath_failed_items: str = None):
+        """
+        Save the failed items, one JSON object per line (JSON Lines).
+
+        The items are already on disk; this closes the file and moves it to
+        its final name. Nothing is written when no item failed.
+        """
+        self._close_failed_items()
+        if self._failed_path is None:
+            print("No highlights failed to format, so no failed items were saved.")
+            return
+
         FAILED_ITEMS_DIR.mkdir(parents=True, exist_ok=True)
         if json_filepath_failed_items:
             out_filepath = FAILED_ITEMS_DIR.joinpath(json_filepath_failed_items)
         else:
-            out_filepath = FAILED_ITEMS_DIR.joinpath("failed_readwise_items.json")
+            out_filepath = FAILED_ITEMS_DIR.joinpath("failed_readwise_items.jsonl")
 
-        with open(out_filepath, "w") as f:
-            dump(self.failed_highlights, f)
+        self._failed_path.replace(out_filepath)
         print(
-            f"{len(self.failed_highlights)} highlights failed to format (hence failed to upload to Readwise).\n"
+            f"{self._failed_count} highlights failed to format (hence failed to upload to Readwise).\n"
             f"Detail of failed items are saved into {out_filepath}"
         )
+        # The saved items now live in out_filepath; start a fresh file
+        self._failed_path = None
+        self._failed_count = 0